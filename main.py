@@ -1,22 +1,43 @@
 from fastapi import FastAPI, Request, Query, HTTPException
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
-import yt_dlp
+import httpx
 import os
+import sys
+import re
+import functools
+import time
 import asyncio
-import subprocess
-import uuid
+import multiprocessing
+import concurrent.futures
+import itertools
+import secrets
+import hashlib
 import logging
 import pathlib
 import tempfile
-from datetime import datetime
+import shutil
+from enum import IntEnum
+from typing import Optional
+
+# inotify is Linux-only (asyncinotify still imports elsewhere); wait_for_file falls back to polling
+Inotify = None
+if sys.platform == "linux":
+    try:
+        from asyncinotify import Inotify, Mask
+    except ImportError:
+        pass
+
+import ydl_worker
 
 # --- Paths ---
 BASE_DIR = pathlib.Path(__file__).parent.resolve()
 COOKIES_FILE = BASE_DIR / "yt.txt"
-HLS_ROOT = pathlib.Path(tempfile.gettempdir()) / "hls_segments"
+HLS_ROOT = (pathlib.Path(tempfile.gettempdir()) / "hls_segments").resolve()
+HLS_MEDIA_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+# nginx internal location mapped to HLS_ROOT (e.g. "/internal-hls"); when set, nginx serves the files
+HLS_ACCEL_REDIRECT = os.environ.get("HLS_ACCEL_REDIRECT", "").rstrip("/")
 
 # --- Ensure dirs exist ---
 HLS_ROOT.mkdir(parents=True, exist_ok=True)
@@ -24,29 +45,264 @@ HLS_ROOT.mkdir(parents=True, exist_ok=True)
 # --- Logging & Concurrency ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
-download_semaphore = asyncio.Semaphore(30)
+# yt-dlp extraction is CPU-heavy; each ffmpeg pulls two HTTPS streams for its whole lifetime
+extract_semaphore = asyncio.Semaphore(10)
+ffmpeg_semaphore = asyncio.Semaphore(30)
+# How long a request may queue for an ffmpeg slot before getting a 503
+FFMPEG_SLOT_TIMEOUT = 15
+
+# --- yt-dlp ---
+# Extractions run in worker processes (see ydl_worker), each holding one YoutubeDL instance
+YDL_WORKERS = 4
+
+# --- Innertube (single-request fast path) ---
+INNERTUBE_PLAYER_URL = "https://www.youtube.com/youtubei/v1/player"
+INNERTUBE_CLIENT = {"clientName": "ANDROID", "clientVersion": "19.09.37", "androidSdkVersion": 30}
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=64),
+    headers={"User-Agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip"},
+)
+
+# --- Format cache ---
+class Resolution(IntEnum):
+    P240 = 240
+    P360 = 360
+    P480 = 480
+    P720 = 720
+    P1080 = 1080
+    P1440 = 1440
+    P2160 = 2160
+
+# Stream URLs carry an `expire` param of ~6h, so keep entries for half that.
+INFO_CACHE_TTL = 3 * 60 * 60
+VIDEO_ID_RE = re.compile(
+    r"(?:https?://)?(?:(?:www|m|music)\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)"
+    r"([\w-]{11})(?![\w-])"
+)
+_INFO_CACHE: dict[tuple[str, int], tuple[float, dict, dict]] = {}
+# Lookups in progress, so concurrent requests for the same key share one extraction
+_INFLIGHT: dict[tuple[str, int], asyncio.Task] = {}
+
+# --- ffmpeg sessions ---
+# Sessions no client has fetched from for this long are deleted (and their ffmpeg killed)
+SESSION_TTL = 30 * 60
+REAPER_INTERVAL = 60
+_SESSIONS: dict[str, asyncio.subprocess.Process] = {}
+_SESSION_ACCESS: dict[str, float] = {}
+# Counter run through a keyed hash: unique per process, unguessable without the random key
+_SID_KEY = secrets.token_bytes(32)
+_SID_COUNTER = itertools.count()
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
 
 # --- FastAPI setup ---
 app = FastAPI(title="YouTube Downloader with HLS", version="2.0.6")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
-app.mount("/hls", StaticFiles(directory=str(HLS_ROOT)), name="hls")
 
+@functools.lru_cache(maxsize=1)
 def load_cookies_header() -> str:
-    cookies = []
-    with open(COOKIES_FILE, "r") as f:
-        for line in f:
-            if line.startswith("#") or not line.strip():
-                continue
-            parts = line.strip().split("\t")
-            if len(parts) >= 7:
-                cookies.append(f"{parts[5]}={parts[6]}")
-    return "; ".join(cookies)
+    data = COOKIES_FILE.read_bytes().decode()
+    return "; ".join(
+        f"{parts[5]}={parts[6]}"
+        for line in data.splitlines()
+        if line and not line.startswith("#")
+        for parts in (line.strip().split("\t"),)
+        if len(parts) >= 7
+    )
+
+# Input options apply to the next -i only, so these are repeated per input
+FFMPEG_INPUT_ARGS = (
+    "-headers", f"Cookie: {load_cookies_header()}\r\n",
+    "-thread_queue_size", "1024",
+    "-fflags", "+nobuffer",
+    "-flags", "low_delay",
+    "-probesize", "1000000",
+    "-analyzeduration", "500000",
+)
+
+def _new_ydl_pool() -> concurrent.futures.ProcessPoolExecutor:
+    # spawn rather than fork: the parent has a running event loop and worker threads
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=YDL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=ydl_worker.init_ydl,
+    )
+
+# Created in the startup hook, so importing main (e.g. as a spawned worker's __mp_main__) never builds one
+_YDL_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+async def _watch_ffmpeg(session_id: str, proc: asyncio.subprocess.Process):
+    # Drain stderr so ffmpeg never blocks on a full pipe, and report failures
+    try:
+        _, stderr = await proc.communicate()
+    finally:
+        ffmpeg_semaphore.release()
+    if proc.returncode:
+        logger.error(f"ffmpeg [{session_id}] exited with {proc.returncode}: {stderr.decode(errors='replace').strip()}")
+
+async def wait_for_file(path: pathlib.Path):
+    inotify = None
+    if Inotify is not None:
+        try:
+            inotify = Inotify()
+            # ffmpeg writes the playlist to a .tmp file and renames it into place
+            inotify.add_watch(path.parent, Mask.CLOSE_WRITE | Mask.MOVED_TO)
+        except OSError:
+            # e.g. EMFILE/ENOSPC once the inotify instance or watch limits are exhausted
+            logger.warning("inotify unavailable, polling for playlist", exc_info=True)
+            if inotify is not None:
+                inotify.close()
+            inotify = None
+    if inotify is None:
+        while not path.exists():
+            await asyncio.sleep(0.5)
+        return
+    with inotify:
+        if path.exists():
+            return
+        async for event in inotify:
+            if event.name is not None and event.name.name == path.name:
+                return
+
+def _innertube_format(f: dict) -> dict:
+    # Map an innertube adaptiveFormat onto the yt-dlp format fields we select on
+    mime, _, params = f.get("mimeType", "").partition(";")
+    kind, _, ext = mime.partition("/")
+    codec = params.partition('"')[2].rstrip('"') or None
+    return {
+        "url": f["url"],
+        "ext": ext,
+        "height": f.get("height"),
+        "vcodec": codec if kind == "video" else "none",
+        "acodec": codec if kind == "audio" else "none",
+        "abr": (f.get("averageBitrate") or f.get("bitrate") or 0) / 1000,
+    }
+
+async def _innertube_formats(video_id: str) -> list:
+    resp = await http_client.post(
+        INNERTUBE_PLAYER_URL,
+        params={"prettyPrint": "false"},
+        json={"context": {"client": INNERTUBE_CLIENT}, "videoId": video_id},
+    )
+    resp.raise_for_status()
+    streaming_data = resp.json().get("streamingData", {})
+    # Ciphered formats (signatureCipher instead of url) need yt-dlp's player decipher
+    return [_innertube_format(f) for f in streaming_data.get("adaptiveFormats", []) if "url" in f]
+
+def select_formats(formats: list, resolution: int) -> tuple[Optional[dict], Optional[dict]]:
+    # Single pass: exact video-only mp4 in requested resolution + best audio-only stream
+    vid_fmt = aud_fmt = None
+    for f in formats:
+        vcodec, acodec = f.get("vcodec"), f.get("acodec")
+        if vcodec == "none":
+            if acodec and acodec != "none" and (aud_fmt is None or (f.get("abr") or 0) > (aud_fmt.get("abr") or 0)):
+                aud_fmt = f
+        elif vid_fmt is None and vcodec and f.get("height") == resolution and f.get("ext") == "mp4":
+            vid_fmt = f
+    return vid_fmt, aud_fmt
+
+async def _lookup_formats(cache_key: tuple[str, int], clean_url: str, video_id: Optional[str]) -> tuple[dict, dict]:
+    global _YDL_POOL
+    resolution = cache_key[1]
+    # 1) Fast path: one innertube request for the formats list
+    vid_fmt = aud_fmt = None
+    if video_id:
+        try:
+            vid_fmt, aud_fmt = select_formats(await _innertube_formats(video_id), resolution)
+        except (httpx.HTTPError, ValueError):
+            logger.warning(f"innertube lookup failed for {video_id}", exc_info=True)
+
+    # 2) Fall back to a full yt-dlp extraction in the worker pool
+    if vid_fmt is None or aud_fmt is None:
+        # clean_url has lost the query string, so watch?v= links need rebuilding
+        extract_url = f"https://www.youtube.com/watch?v={video_id}" if video_id else clean_url
+        async with extract_semaphore:
+            pool = _YDL_POOL
+            try:
+                formats = await asyncio.get_running_loop().run_in_executor(pool, ydl_worker.extract, extract_url)
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (OOM, killed); replace the pool so later requests recover
+                if pool is _YDL_POOL:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    _YDL_POOL = _new_ydl_pool()
+                raise
+        vid_fmt, aud_fmt = select_formats(formats, resolution)
+    if vid_fmt is None or aud_fmt is None:
+        raise HTTPException(status_code=404, detail=f"No {resolution}p stream available")
+    _INFO_CACHE[cache_key] = (time.monotonic(), vid_fmt, aud_fmt)
+    return vid_fmt, aud_fmt
+
+def _finish_lookup(cache_key: tuple[str, int], task: asyncio.Task):
+    _INFLIGHT.pop(cache_key, None)
+    # Mark the exception retrieved in case every waiter was cancelled before it finished
+    if not task.cancelled():
+        task.exception()
+
+async def _reap_sessions():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        try:
+            for session_id, proc in list(_SESSIONS.items()):
+                if proc.returncode is not None:
+                    del _SESSIONS[session_id]
+
+            # Expired format entries are otherwise only replaced when the same key is requested again
+            now = time.monotonic()
+            for cache_key, (ts, _, _) in list(_INFO_CACHE.items()):
+                if now - ts > INFO_CACHE_TTL:
+                    del _INFO_CACHE[cache_key]
+
+            cutoff = time.time() - SESSION_TTL
+            for sess_dir in HLS_ROOT.iterdir():
+                session_id = sess_dir.name
+                # Only client fetches count: a running ffmpeg keeps the dir mtime fresh on its own.
+                # Dirs unknown to this process (left by an earlier run) fall back to their mtime.
+                last_access = _SESSION_ACCESS.get(session_id)
+                if last_access is None:
+                    last_access = sess_dir.stat().st_mtime
+                if last_access >= cutoff:
+                    continue
+                proc = _SESSIONS.pop(session_id, None)
+                if proc is not None and proc.returncode is None:
+                    proc.kill()
+                _SESSION_ACCESS.pop(session_id, None)
+                await asyncio.to_thread(shutil.rmtree, sess_dir, ignore_errors=True)
+                logger.info(f"reaped HLS session {session_id}")
+        except Exception:
+            logger.error("session reaper error", exc_info=True)
+
+def new_session_id() -> str:
+    n = next(_SID_COUNTER)
+    return hashlib.blake2b(n.to_bytes(8, "big"), key=_SID_KEY, digest_size=12).hexdigest()
+
+def extract_video_id(url: str) -> Optional[str]:
+    match = VIDEO_ID_RE.match(url.strip())
+    return match.group(1) if match else None
+
+@app.on_event("startup")
+async def start_ydl_pool():
+    global _YDL_POOL
+    _YDL_POOL = _new_ydl_pool()
+
+@app.on_event("startup")
+async def start_reaper():
+    task = asyncio.create_task(_reap_sessions())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+@app.on_event("shutdown")
+async def close_clients():
+    await http_client.aclose()
+    if _YDL_POOL is not None:
+        _YDL_POOL.shutdown(wait=False, cancel_futures=True)
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start = datetime.now()
+    start = time.perf_counter_ns()
     response = await call_next(request)
-    ms = (datetime.now() - start).microseconds / 1000
+    ms = (time.perf_counter_ns() - start) / 1e6
     logger.info(f"{request.client.host} {request.method} {request.url} -> {response.status_code} [{ms:.1f}ms]")
     return response
 
@@ -54,51 +310,67 @@ async def log_requests(request: Request, call_next):
 async def root():
     return JSONResponse({"status": "ok"})
 
+def _resolve_hls_file(path: str) -> pathlib.Path:
+    file_path = (HLS_ROOT / path).resolve()
+    if not file_path.is_relative_to(HLS_ROOT) or not file_path.is_file():
+        raise HTTPException(status_code=404, detail="Not Found")
+    _SESSION_ACCESS[file_path.relative_to(HLS_ROOT).parts[0]] = time.time()
+    return file_path
+
+# Registered before the generic /hls route so player polls of the playlist can revalidate
+@app.api_route("/hls/{session_id}/index.m3u8", methods=["GET", "HEAD"], summary="HLS playlist")
+async def serve_playlist(request: Request, session_id: str):
+    file_path = _resolve_hls_file(f"{session_id}/index.m3u8")
+    stat = file_path.stat()
+    etag = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"Cache-Control": "max-age=2, must-revalidate", "ETag": etag}
+    if_none_match = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if "*" in if_none_match or etag.removeprefix("W/") in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, media_type=HLS_MEDIA_TYPES[".m3u8"], headers=headers, stat_result=stat)
+
+@app.api_route("/hls/{path:path}", methods=["GET", "HEAD"], name="hls", summary="HLS files")
+async def serve_hls(path: str):
+    file_path = _resolve_hls_file(path)
+    media_type = HLS_MEDIA_TYPES.get(file_path.suffix, "application/octet-stream")
+    if HLS_ACCEL_REDIRECT:
+        return Response(media_type=media_type, headers={"X-Accel-Redirect": f"{HLS_ACCEL_REDIRECT}/{file_path.relative_to(HLS_ROOT).as_posix()}"})
+    # FileResponse streams via os.sendfile where available
+    return FileResponse(file_path, media_type=media_type)
+
 @app.get("/stream/", summary="HLS stream")
-async def stream_video(request: Request, url: str = Query(...), resolution: int = Query(1080)):
+async def stream_video(request: Request, url: str = Query(...), resolution: Resolution = Query(Resolution.P1080)):
     clean_url = url.split("?", 1)[0]
+    video_id = extract_video_id(url)
+    cache_key = (video_id or clean_url, int(resolution))
     try:
-        # 1) Extract formats with latest yt-dlp and Android player_client hack
-        ydl_opts = {
-            "quiet": True,
-            "cookiefile": str(COOKIES_FILE),
-            "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-            "extractor_args": {"youtube": {"player_client": "android"}},
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(clean_url, download=False)
-
-        # 2) Exact video-only mp4 in requested resolution
-        vid_fmt = next(
-            f
-            for f in info["formats"]
-            if f.get("vcodec") != "none"
-            and f.get("height") == resolution
-            and f.get("ext") == "mp4"
-        )
-        # 3) Best audio-only stream
-        aud_fmt = max(
-            (f for f in info["formats"] if f.get("vcodec") == "none" and f.get("acodec") != "none"),
-            key=lambda x: x.get("abr", 0),
-        )
-
-        # 4) Prepare HLS session directory
-        session_id = uuid.uuid4().hex
+        # 1-2) Cached formats, else join (or start) the in-flight lookup
+        cached = _INFO_CACHE.get(cache_key)
+        if cached and time.monotonic() - cached[0] <= INFO_CACHE_TTL:
+            _, vid_fmt, aud_fmt = cached
+        else:
+            task = _INFLIGHT.get(cache_key)
+            if task is None:
+                task = asyncio.create_task(_lookup_formats(cache_key, clean_url, video_id))
+                _INFLIGHT[cache_key] = task
+                task.add_done_callback(functools.partial(_finish_lookup, cache_key))
+            # Shield so one caller disconnecting doesn't cancel the lookup for the others
+            vid_fmt, aud_fmt = await asyncio.shield(task)
+
+        # 3) Pick HLS session directory (created once an ffmpeg slot is free)
+        session_id = new_session_id()
         sess_dir = HLS_ROOT / session_id
-        sess_dir.mkdir(parents=True, exist_ok=True)
 
-        # 5) Spawn ffmpeg to generate .m3u8 + .ts segments
-        cookie_header = load_cookies_header()
-        hdr = ["-headers", f"Cookie: {cookie_header}\r\n"]
+        # 4) Spawn ffmpeg to generate .m3u8 + .ts segments
         cmd = [
             "ffmpeg",
             "-hide_banner",
             "-loglevel",
             "error",
-            *hdr,
+            *FFMPEG_INPUT_ARGS,
             "-i",
             vid_fmt["url"],
-            *hdr,
+            *FFMPEG_INPUT_ARGS,
             "-i",
             aud_fmt["url"],
             "-c:v",
@@ -107,6 +379,8 @@ async def stream_video(request: Request, url: str = Query(...), resolution: int
             "copy",
             "-f",
             "hls",
+            "-hls_playlist_type",
+            "event",
             "-hls_time",
             "4",
             "-hls_list_size",
@@ -117,24 +391,42 @@ async def stream_video(request: Request, url: str = Query(...), resolution: int
             str(sess_dir / "seg_%03d.ts"),
             str(sess_dir / "index.m3u8"),
         ]
-        proc = subprocess.Popen(cmd, cwd=str(sess_dir))
+        # The slot is released by _watch_ffmpeg once the process exits
+        try:
+            await asyncio.wait_for(ffmpeg_semaphore.acquire(), timeout=FFMPEG_SLOT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Too many active streams, try again later")
+        try:
+            sess_dir.mkdir(parents=True, exist_ok=True)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                cwd=str(sess_dir),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except BaseException:
+            ffmpeg_semaphore.release()
+            raise
+        _SESSIONS[session_id] = proc
+        _SESSION_ACCESS[session_id] = time.time()
+        task = asyncio.create_task(_watch_ffmpeg(session_id, proc))
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
 
-        # 6) Wait up to ~10s for playlist to appear
-        playlist_path = sess_dir / "index.m3u8"
-        for _ in range(20):
-            if playlist_path.exists():
-                break
-            await asyncio.sleep(0.5)
-        else:
-            proc.kill()
+        # 5) Wait up to 10s for playlist to appear
+        try:
+            await asyncio.wait_for(wait_for_file(sess_dir / "index.m3u8"), timeout=10)
+        except asyncio.TimeoutError:
+            if proc.returncode is None:
+                proc.kill()
             raise HTTPException(status_code=500, detail="HLS playlist generation failed")
 
-        # 7) Redirect client to the m3u8
+        # 6) Redirect client to the m3u8
         playlist_url = request.url_for("hls", path=f"{session_id}/index.m3u8")
         return RedirectResponse(playlist_url)
 
-    except StopIteration:
-        raise HTTPException(status_code=404, detail=f"No {resolution}p stream available")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("stream_video error", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
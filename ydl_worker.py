@@ -0,0 +1,33 @@
+import pathlib
+
+import yt_dlp
+
+# Loaded by the ProcessPoolExecutor workers in main and kept free of the app. Note that
+# spawn still re-imports the parent's __main__ script in each worker, so run the server
+# with `python -m uvicorn main:app` rather than executing main.py directly.
+
+COOKIES_FILE = pathlib.Path(__file__).parent.resolve() / "yt.txt"
+YDL_OPTS = {
+    "quiet": True,
+    "cookiefile": str(COOKIES_FILE),
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "extractor_args": {"youtube": {"player_client": "android"}},
+}
+# One long-lived YoutubeDL instance per worker process
+_YDL = None
+
+class ExtractError(Exception):
+    # DownloadError carries exc_info (a traceback) and can't be pickled back to the API process
+    pass
+
+def init_ydl():
+    global _YDL
+    _YDL = yt_dlp.YoutubeDL(YDL_OPTS)
+
+def extract(url: str) -> list:
+    # Latest yt-dlp with Android player_client hack; only the formats list goes back
+    try:
+        info = _YDL.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        raise ExtractError(str(e)) from None
+    return _YDL.sanitize_info(info)["formats"]